@@ -11,14 +11,16 @@
 #  limitations under the License.
 # ========================================================================
 
+import concurrent.futures
 import logging
+import threading
 
-import qt, ctk, slicer
-from collections import deque
-from slicer.ScriptedLoadableModule import *
+import qt, ctk, slicer, vtk
+from slicer.ScriptedLoadableModule import ScriptedLoadableModule, ScriptedLoadableModuleWidget, \
+  ScriptedLoadableModuleLogic
 
-from SlicerCaseIteratorLib import IteratorBase
-from SlicerCaseIteratorLib.IteratorFactory import IteratorFactory
+# NB: SlicerCaseIteratorLib (which imports all iterator implementations) is imported where it is first used, so it is
+# not loaded while Slicer starts up, but only once the module is opened
 
 
 # ------------------------------------------------------------------------------
@@ -52,16 +54,36 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Logger for the extension log messages
+  logger = logging.getLogger('SlicerCaseIterator')
+
   def __del__(self):
     self.logger.debug('Destroying Slicer Case Iterator Widget')
     self.logic = None
     self.inputWidget = None
     self._disconnectHandlers()
 
+  def cleanup(self):
+    # Called by Slicer before the module is reloaded or the application exits
+    self._deleteViewButtons()
+
+    # Stop reading files in the background for a running batch
+    if self.logic is not None:
+      self.logic.shutdown()
+
+    # Remove the scene observers. Their callbacks are bound methods, so they would otherwise keep this widget alive
+    self._disconnectHandlers()
+
+    # Remove the keyboard shortcuts. These are owned by the main window, so let Qt delete them
+    for sc in self.shortcuts:
+      sc.disconnect('activated()')
+      sc.deleteLater()
+    self.shortcuts = []
+
   def onReload(self):
-    if hasattr(self, 'inputWidget'):
-      self.inputWidget = None
+    self.inputWidget = None
 
+    from SlicerCaseIteratorLib.IteratorFactory import IteratorFactory
     IteratorFactory.reloadSourceFiles()
     ScriptedLoadableModuleWidget.onReload(self)
 
@@ -70,16 +92,36 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
 
     self.setupViewSettingsArea()
 
-    # Setup a logger for the extension log messages
-    self.logger = logging.getLogger('SlicerCaseIterator')
-
     self.logic = None
 
+    # Input widget of the selected mode and its parameters groupbox, set in onModeSelected
+    self.selectedMode = None
+    self.inputWidget = None
+    self.inputParametersGroupBox = None
+
     # These variables hold connections to other parts of Slicer, such as registered keyboard shortcuts and
-    # Event observers
+    # Event observers (stored as (observed object, observer tag) tuples)
     self.shortcuts = []
     self.observers = []
 
+    # The CTRL + N and CTRL + P shortcuts are created once, and only enabled while a batch is running
+    shortcutNext = qt.QShortcut(slicer.util.mainWindow())
+    shortcutNext.setKey(qt.QKeySequence('Ctrl+N'))
+    shortcutNext.setEnabled(False)
+
+    shortcutNext.connect('activated()', self.onNext)
+    self.shortcuts.append(shortcutNext)
+
+    shortcutPrevious = qt.QShortcut(slicer.util.mainWindow())
+    shortcutPrevious.setKey(qt.QKeySequence('Ctrl+P'))
+    shortcutPrevious.setEnabled(False)
+
+    shortcutPrevious.connect('activated()', self.onPrevious)
+    self.shortcuts.append(shortcutPrevious)
+
+    # Segmentation nodes in the scene, kept up to date by scene observers while a batch is running (None otherwise)
+    self._segmentationNodes = None
+
     # Instantiate and connect widgets ...
 
     #
@@ -89,6 +131,7 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     self.modeGroup.setLayout(qt.QFormLayout())
     self.layout.addWidget(self.modeGroup)
 
+    from SlicerCaseIteratorLib.IteratorFactory import IteratorFactory
     modes = IteratorFactory.getImplementationNames()
     self.modeComboBox = qt.QComboBox()
     self.modeComboBox.addItems([""] + modes)
@@ -101,6 +144,9 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     self.inputDataCollapsibleButton.text = 'Select and Load case data'
     self.layout.addWidget(self.inputDataCollapsibleButton)
 
+    # Layout holding the input widget of the selected mode, filled in onModeSelected
+    self.inputDataFormLayout = qt.QFormLayout(self.inputDataCollapsibleButton)
+
     #
     # Parameters Area
     #
@@ -159,13 +205,13 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     self.sliceOutline2DSlider.value = 1.0
     self.maskGroup.layout().addRow("Slice 2D outline:", self.sliceOutline2DSlider)
 
-    #
-    # Progressbar
-    #
-    self.progressBar = qt.QProgressBar()
-    self.progressBar.setFormat("%v/%m")
-    self.progressBar.visible = False
-    self.layout.addWidget(self.progressBar)
+    # Timer coalescing the slider changes (e.g. while dragging) into at most one update of the segmentations per frame
+    self.segmentationPropertiesTimer = qt.QTimer()
+    self.segmentationPropertiesTimer.setSingleShot(True)
+    self.segmentationPropertiesTimer.setInterval(16)
+
+    # Progressbar, only created when the first batch is started (see _ensureProgressBar)
+    self.progressBar = None
 
     #
     # Case Button Row
@@ -215,8 +261,9 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     self.previousButton.connect('clicked(bool)', self.onPrevious)
     self.nextButton.connect('clicked(bool)', self.onNext)
     self.resetButton.connect('clicked(bool)', self.onReset)
-    self.sliceFill2DSlider.valueChanged.connect(self.updateSegmentationProperties)
-    self.sliceOutline2DSlider.valueChanged.connect(self.updateSegmentationProperties)
+    self.sliceFill2DSlider.valueChanged.connect(self.onSegmentationPropertiesChanged)
+    self.sliceOutline2DSlider.valueChanged.connect(self.onSegmentationPropertiesChanged)
+    self.segmentationPropertiesTimer.timeout.connect(self.updateSegmentationProperties)
 
     if len(modes) == 1:
       self.modeComboBox.hide()
@@ -225,6 +272,7 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     self._setGUIstate(csv_loaded=False)
 
   def setupViewSettingsArea(self):
+    self.viewButtons = ()
     try:
       from SlicerDevelopmentToolboxUtils.buttons import FourUpLayoutButton, FourUpTableViewLayoutButton, CrosshairButton
       from SlicerDevelopmentToolboxUtils.mixins import ModuleWidgetMixin
@@ -233,6 +281,7 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
       self.fourUpSliceTableViewLayoutButton = FourUpTableViewLayoutButton()
       self.crosshairButton = CrosshairButton()
       self.crosshairButton.setSliceIntersectionEnabled(True)
+      self.viewButtons = (self.fourUpSliceLayoutButton, self.fourUpSliceTableViewLayoutButton, self.crosshairButton)
 
       hbox = ModuleWidgetMixin.createHLayout([self.fourUpSliceLayoutButton,
                                               self.fourUpSliceTableViewLayoutButton, self.crosshairButton])
@@ -242,20 +291,35 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
                    "for setting up the view settings area.  Please Install SlicerDevelopmentToolbox from the extension "
                    "manager if you want to make use of it.")
 
+  # ------------------------------------------------------------------------------
+  def _deleteViewButtons(self):
+    # The view buttons observe the layout and crosshair, so delete them explicitly instead of waiting for the GC
+    for button in self.viewButtons:
+      button.deleteLater()
+    self.viewButtons = ()
+
   # ------------------------------------------------------------------------------
   def enter(self):
-    if hasattr(self, 'inputWidget'):
+    if self.inputWidget is not None:
       self.inputWidget.enter()
 
   # ------------------------------------------------------------------------------
   def onModeSelected(self, mode):
+    # Nothing to do for the empty placeholder entry, or when the mode is selected again
+    if mode == '' or mode == self.selectedMode:
+      return
+    self.selectedMode = mode
+
     # Setup the widget for CSV table input
+    from SlicerCaseIteratorLib.IteratorFactory import IteratorFactory
     self.inputWidget = IteratorFactory.getIteratorWidget(mode)()
     self.inputWidget.validationHandler = self.onValidateInput
 
-    inputDataFormLayout = qt.QFormLayout(self.inputDataCollapsibleButton)
+    # Remove the input widget of a previously selected mode (this also deletes its widgets)
+    while self.inputDataFormLayout.rowCount() > 0:
+      self.inputDataFormLayout.removeRow(0)
     self.inputParametersGroupBox = self.inputWidget.setup()
-    inputDataFormLayout.addRow(self.inputParametersGroupBox)
+    self.inputDataFormLayout.addRow(self.inputParametersGroupBox)
 
     self.modeGroup.hide()
     self.inputDataCollapsibleButton.click()
@@ -265,15 +329,27 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     self.resetButton.enabled = is_valid
 
   # ------------------------------------------------------------------------------
-  def updateSegmentationProperties(self, value=None):
-    def update(segNode):
-      try:
-        segNode.GetDisplayNode().SetOpacity2DFill(self.sliceFill2DSlider.value)
-        segNode.GetDisplayNode().SetOpacity2DOutline(self.sliceOutline2DSlider.value)
-      except AttributeError:
-        pass
+  def onSegmentationPropertiesChanged(self, value=None):
+    # Changes made while an update is pending are picked up by that update, as it reads the current slider values
+    if not self.segmentationPropertiesTimer.isActive():
+      self.segmentationPropertiesTimer.start()
 
-    deque(map(update, slicer.util.getNodesByClass("vtkMRMLSegmentationNode")))
+  # ------------------------------------------------------------------------------
+  def updateSegmentationProperties(self, value=None):
+    fill = self.sliceFill2DSlider.value
+    outline = self.sliceOutline2DSlider.value
+
+    segNodes = self._segmentationNodes
+    if segNodes is None:
+      segNodes = slicer.util.getNodesByClass("vtkMRMLSegmentationNode")
+    for segNode in segNodes:
+      displayNode = segNode.GetDisplayNode()
+      if displayNode is not None:
+        # Set both opacities in one transaction, so the views are only updated once per node
+        wasModifying = displayNode.StartModify()
+        displayNode.SetOpacity2DFill(fill)
+        displayNode.SetOpacity2DOutline(outline)
+        displayNode.EndModify(wasModifying)
 
   # ------------------------------------------------------------------------------
   def onReset(self):
@@ -282,6 +358,8 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
       # Lock GUI during loading
       self._unlockGUI(False)
 
+      # Starting the batch reads the case table and loads the first case, which may take a while for large batches
+      slicer.app.setOverrideCursor(qt.Qt.WaitCursor)
       try:
         reader = self.txtReaderName.text
         if reader == '':
@@ -293,15 +371,20 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
         self.updateSegmentationProperties()
         self._setGUIstate()
         self._unlockGUI(True)
-      except Exception as e:
-        if slicer.app.majorVersion * 100 + slicer.app.minorVersion < 411:
-          e = e.message
-        self.logger.error('Error loading batch! %s', e)
-        self.logger.debug('', exc_info=True)
+      except Exception:
+        self.logger.exception('Error loading batch!')
+        if self.logic is not None:
+          # The batch was created, but could not be started. Stop its background reads and discard it
+          self.logic.shutdown()
+          self.inputWidget.cleanupBatch()
+          self.logic = None
         self._setGUIstate(csv_loaded=False)
+      finally:
+        slicer.app.restoreOverrideCursor()
 
     else:
       # End the batch and clean up
+      self.logic.shutdown()
       self.inputWidget.cleanupBatch()
       self.logic = None
       self._setGUIstate(csv_loaded=False)
@@ -311,7 +394,7 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     # Lock GUI during loading
     self._unlockGUI(False)
 
-    self.logic.previousCase()
+    self.logic.advanceCase(-1)
     self.progressBar.value = self.logic.currentIdx+1
     self.updateSegmentationProperties()
 
@@ -323,7 +406,7 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
     # Lock GUI during loading
     self._unlockGUI(False)
 
-    if self.logic.nextCase():
+    if self.logic.advanceCase(1):
       # Last case processed, reset GUI
       self.onReset()
     else:
@@ -344,58 +427,83 @@ class SlicerCaseIteratorWidget(ScriptedLoadableModuleWidget):
       self.nextButton.text = 'Loading...'
 
   # ------------------------------------------------------------------------------
-  def _setGUIstate(self, csv_loaded=True):
-    if csv_loaded:
-      self.resetButton.enabled = True
-      self.resetButton.text = 'Reset'
-
-      self.progressBar.value = 1
-      self.progressBar.maximum = self.logic.iterator.caseCount
-      self._connectHandlers()
-    else:
-      # reset Button is locked when loading cases, ensure it is unlocked to load new batch
-      self.resetButton.enabled = hasattr(self, 'inputWidget') and self.inputWidget.is_valid()
-      self.resetButton.text = 'Start Batch'
-
-      self._disconnectHandlers()
+  def _ensureProgressBar(self):
+    if self.progressBar is None:
+      self.progressBar = qt.QProgressBar()
+      self.progressBar.setFormat("%v/%m")
+      self.progressBar.visible = False
+      # Place it directly above the case buttons, where it would have been added in setup
+      self.layout.insertWidget(self.layout.indexOf(self.caseButtonWidget), self.progressBar)
+    return self.progressBar
 
-    self.progressBar.visible = csv_loaded
-    self.previousButton.enabled = csv_loaded
-    self.nextButton.enabled = csv_loaded
-
-    if hasattr(self, 'inputParametersGroupBox'):
-      self.inputParametersGroupBox.enabled = not csv_loaded
+  # ------------------------------------------------------------------------------
+  def _setGUIstate(self, csv_loaded=True):
+    # Suspend repainting while toggling the widgets, so the panel is repainted once instead of once per widget
+    self.parent.setUpdatesEnabled(False)
+    try:
+      if csv_loaded:
+        self.resetButton.enabled = True
+        self.resetButton.text = 'Reset'
+
+        # Set the range before the value, as values outside the current range are ignored by the progress bar
+        self._ensureProgressBar()
+        self.progressBar.maximum = self.logic.iterator.caseCount
+        self.progressBar.value = self.logic.currentIdx + 1
+        self._connectHandlers()
+      else:
+        # reset Button is locked when loading cases, ensure it is unlocked to load new batch
+        self.resetButton.enabled = self.inputWidget is not None and self.inputWidget.is_valid()
+        self.resetButton.text = 'Start Batch'
+
+        self._disconnectHandlers()
+
+      if self.progressBar is not None:
+        self.progressBar.visible = csv_loaded
+      self.previousButton.enabled = csv_loaded
+      self.nextButton.enabled = csv_loaded
+
+      if self.inputParametersGroupBox is not None:
+        self.inputParametersGroupBox.enabled = not csv_loaded
+    finally:
+      self.parent.setUpdatesEnabled(True)
+      self.parent.update()
 
   # ------------------------------------------------------------------------------
   def _connectHandlers(self):
-    # Connect the CTRL + N and CTRL + P Shortcut
-    if len(self.shortcuts) == 0:
-      shortcutNext = qt.QShortcut(slicer.util.mainWindow())
-      shortcutNext.setKey(qt.QKeySequence('Ctrl+N'))
+    # Enable the CTRL + N and CTRL + P Shortcut
+    for sc in self.shortcuts:
+      sc.setEnabled(True)
 
-      shortcutNext.connect('activated()', self.onNext)
-      self.shortcuts.append(shortcutNext)
+    # Keep track of the segmentation nodes, so changing the mask properties does not need to search the scene
+    if len(self.observers) == 0:
+      self._segmentationNodes = list(slicer.util.getNodesByClass("vtkMRMLSegmentationNode"))
+      for event, callback in ((slicer.vtkMRMLScene.NodeAddedEvent, self._onNodeAdded),
+                              (slicer.vtkMRMLScene.NodeRemovedEvent, self._onNodeRemoved)):
+        self.observers.append((slicer.mrmlScene, slicer.mrmlScene.AddObserver(event, callback)))
 
-      shortcutPrevious = qt.QShortcut(slicer.util.mainWindow())
-      shortcutPrevious.setKey(qt.QKeySequence('Ctrl+P'))
+  # ------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeAdded(self, caller, event, node):
+    if node.IsA('vtkMRMLSegmentationNode'):
+      self._segmentationNodes.append(node)
 
-      shortcutPrevious.connect('activated()', self.onPrevious)
-      self.shortcuts.append(shortcutPrevious)
-    else:
-      self.logger.warning('Shortcuts already initialized!')
+  # ------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeRemoved(self, caller, event, node):
+    if node.IsA('vtkMRMLSegmentationNode') and node in self._segmentationNodes:
+      self._segmentationNodes.remove(node)
 
   # ------------------------------------------------------------------------------
   def _disconnectHandlers(self):
-    # Remove the keyboard shortcut
+    # Disable the keyboard shortcuts
     for sc in self.shortcuts:
-      sc.disconnect('activated()')
-      sc.setParent(None)
-    self.shortcuts = []
+      sc.setEnabled(False)
 
-    # Remove the event observer
-    for obs in self.observers:
-      slicer.mrmlScene.RemoveObserver(obs)
+    # Remove the event observers from the objects they were added to
+    for obj, tag in self.observers:
+      obj.RemoveObserver(tag)
     self.observers = []
+    self._segmentationNodes = None
 
 
 # ------------------------------------------------------------------------------
@@ -409,12 +517,25 @@ class SlicerCaseIteratorLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  def __init__(self, iterator, start):
+  logger = logging.getLogger('SlicerCaseIterator.logic')
+
+  # Maximum number of cases of which the files are read simultaneously in the background
+  MAX_PREFETCH_WORKERS = 4
+
+  def __init__(self, iterator, start, prefetchRadius=2):
     ScriptedLoadableModuleLogic.__init__(self)
 
-    self.logger = logging.getLogger('SlicerCaseIterator.logic')
+    # Background threads reading the files of upcoming cases while the user reviews the current one. Only the file
+    # reading is done in the background (warming the OS file cache), loading into the MRML scene stays on the main thread
+    self.prefetchRadius = prefetchRadius  # Number of cases to prefetch in the direction of navigation, plus 1 behind
+    self._direction = 1  # Direction of the last navigation step (1: next, -1: previous)
+    self._prefetchExecutor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(prefetchRadius + 1, self.MAX_PREFETCH_WORKERS))
+    self._prefetchFutures = {}  # Maps case index to the future reading the files of that case
+    self._prefetchStop = threading.Event()  # Set on shutdown, stopping the reads that are already running
 
     # Iterator class defining the iterable to iterate over cases
+    from SlicerCaseIteratorLib import IteratorBase
     assert isinstance(iterator, IteratorBase.IteratorLogicBase)
     self.iterator = iterator
     assert self.iterator.caseCount >= start, 'No cases to process (%d cases, start %d)' % (self.iterator.caseCount,
@@ -424,19 +545,39 @@ class SlicerCaseIteratorLogic(ScriptedLoadableModuleLogic):
   def __del__(self):
     # Free up the references to the nodes to allow GC and prevent memory leaks
     self.logger.debug('Destroying Case Iterator Logic instance')
+    self.shutdown()
     self.iterator = None
 
+  def shutdown(self):
+    """
+    Stop reading files in the background. Pending reads are cancelled, and running reads stop after their current
+    chunk. Call this when the batch ends, as the logic may outlive it. Calling it again has no effect.
+    :return: None
+    """
+    self._prefetchStop.set()
+    for future in self._prefetchFutures.values():
+      future.cancel()
+    self._prefetchFutures = {}
+    self._prefetchExecutor.shutdown(wait=True)
+
   def start(self):
     self._loadCase()
 
   # ------------------------------------------------------------------------------
-  def nextCase(self):
-    self.currentIdx += 1
+  def advanceCase(self, delta):
+    """
+    Move ``delta`` cases forward (or backward if negative) in the batch and load that case.
+    :return: Boolean indicating whether the end of the batch is reached
+    """
+    self.currentIdx += delta
+    self._direction = 1 if delta >= 0 else -1
     return self._loadCase()
 
+  def nextCase(self):
+    return self.advanceCase(1)
+
   def previousCase(self):
-    self.currentIdx -= 1
-    return self._loadCase()
+    return self.advanceCase(-1)
 
   def _loadCase(self):
     """
@@ -451,16 +592,57 @@ class SlicerCaseIteratorLogic(ScriptedLoadableModuleLogic):
       self.logger.warning('First case selected, cannot select previous case!')
       return False
 
-    if self.iterator.currentIdx is not None:
-      self._closeCase()
+    # Start reading the files of the new case (if not prefetched already), so this overlaps with closing the current
+    # case. Past the last case, there is nothing left to read, so only cancel the pending reads
+    if self.currentIdx < self.iterator.caseCount:
+      self._schedulePrefetch([self.currentIdx] + self._getPrefetchWindow())
+    else:
+      self._schedulePrefetch([])
+
+    # Closing and loading a case changes the nodes shown in every view several times (volumes, masks, slice
+    # orientation), so only render the views once when the new case is fully set up
+    slicer.app.pauseRender()
+    try:
+      if self.iterator.currentIdx is not None:
+        self.iterator.closeCase()
 
-    if self.currentIdx >= self.iterator.caseCount:
-      self.logger.info('########## All Done! ##########')
-      return True
+      if self.currentIdx >= self.iterator.caseCount:
+        self.logger.info('########## All Done! ##########')
+        return True
 
-    self.iterator.loadCase(self.currentIdx)
+      self.iterator.loadCase(self.currentIdx)
+    finally:
+      slicer.app.resumeRender()
+    self._schedulePrefetch(self._getPrefetchWindow())
 
     return False
 
-  def _closeCase(self):
-    self.iterator.closeCase()
+  def _getPrefetchWindow(self):
+    # Prefetch the cases the user is heading to first, then the case right behind in case they turn around
+    return [self.currentIdx + self._direction * offset for offset in range(1, self.prefetchRadius + 1)] + \
+           [self.currentIdx - self._direction]
+
+  # ------------------------------------------------------------------------------
+  def _schedulePrefetch(self, case_indices):
+    """
+    Start reading the files of the specified cases in the background. Pending reads of cases not in case_indices are
+    cancelled.
+    :param case_indices: indices of the cases to prefetch, indices out of range are ignored
+    :return: None
+    """
+    case_indices = [idx for idx in case_indices if 0 <= idx < self.iterator.caseCount]
+    for idx in list(self._prefetchFutures.keys()):
+      if idx not in case_indices:
+        self._prefetchFutures.pop(idx).cancel()
+
+    for idx in case_indices:
+      if idx not in self._prefetchFutures:
+        # Resolve the file paths here, as the iterator may only be accessed from the main thread
+        try:
+          paths = self.iterator.getCaseFiles(idx)
+        except Exception:
+          # Prefetching is an optimization only, errors in the case are reported when it is actually loaded
+          self.logger.debug('Failed to get files to prefetch for case %d', idx, exc_info=True)
+          continue
+        self._prefetchFutures[idx] = self._prefetchExecutor.submit(self.iterator.readFiles, paths,
+                                                                     stopEvent=self._prefetchStop)
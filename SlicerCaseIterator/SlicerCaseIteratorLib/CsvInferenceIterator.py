@@ -1,5 +1,7 @@
+import concurrent.futures
 import os
-from collections import OrderedDict, deque
+import threading
+from collections import deque
 
 import vtk
 import qt
@@ -15,6 +17,10 @@ from . import IteratorBase
 
 class CsvInferenceIteratorWidget(IteratorBase.IteratorWidgetBase):
 
+  # Maximum number of threads reading case files in the background while preloading, this is also the number of cases
+  # read ahead of the case being loaded
+  PRELOAD_READ_WORKERS = 4
+
   def __init__(self):
 
     try:
@@ -27,6 +33,10 @@ class CsvInferenceIteratorWidget(IteratorBase.IteratorWidgetBase):
     self.tableNode = None
     self.tableStorageNode = None
 
+    # Column names parsed from the groundtruth/predicted masks selectors, updated whenever their text changes
+    self._gtMaskColumns = ()
+    self._predMaskColumns = ()
+
   # ------------------------------------------------------------------------------
   def setup(self):
     self.CsvInputGroupBox = qt.QGroupBox('CSV input for local files')
@@ -143,8 +153,13 @@ class CsvInferenceIteratorWidget(IteratorBase.IteratorWidgetBase):
     #
     self.batchTableSelector.connect('nodeActivated(vtkMRMLNode*)', self.onChangeTable)
     self.imageSelector.connect('textEdited(QString)', self.onChangeImageColumn)
+    self.inputGTMaskColumnNames.connect('textChanged(QString)', self.onChangeGTMaskColumns)
+    self.inputPredMaskColumnNames.connect('textChanged(QString)', self.onChangePredMaskColumns)
     self.preloadCases.stateChanged.connect(self.onPreloadCasesChanged)
 
+    self.onChangeGTMaskColumns(self.inputGTMaskColumnNames.text)
+    self.onChangePredMaskColumns(self.inputPredMaskColumnNames.text)
+
     return self.CsvInputGroupBox
 
   # ------------------------------------------------------------------------------
@@ -191,11 +206,31 @@ class CsvInferenceIteratorWidget(IteratorBase.IteratorWidgetBase):
     self.progressBar.maximum = self._iterator.caseCount
     self.progressBar.visible = True
     slicer.app.processEvents()
-    for caseIdx in range(self._iterator.caseCount):
-      self._iterator.loadCase(caseIdx)
-      self.progressBar.value = self._iterator.currentIdx + 1
-    self._iterator.closeCase()
-    self.progressBar.visible = False
+
+    # Loading into the scene must happen on the main thread, but the files of the cases can be read in parallel in the
+    # background. Only a few cases are read ahead of the case being loaded, so their files are still in the file cache
+    # when they are loaded
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.PRELOAD_READ_WORKERS)
+    stopEvent = threading.Event()
+    futures = {}  # Maps case index to the future reading the files of that case
+    nextReadIdx = 0
+    try:
+      for caseIdx in range(self._iterator.caseCount):
+        while nextReadIdx < min(caseIdx + 1 + self.PRELOAD_READ_WORKERS, self._iterator.caseCount):
+          futures[nextReadIdx] = executor.submit(self._iterator.readFiles, self._iterator.getCaseFiles(nextReadIdx),
+                                                 stopEvent=stopEvent)
+          nextReadIdx += 1
+        futures.pop(caseIdx)
+
+        self._iterator.loadCase(caseIdx)
+        self.progressBar.value = self._iterator.currentIdx + 1
+      self._iterator.closeCase()
+    finally:
+      stopEvent.set()
+      for future in futures.values():
+        future.cancel()
+      executor.shutdown(wait=False)
+      self.progressBar.visible = False
 
   # ------------------------------------------------------------------------------
   def cleanupBatch(self):
@@ -214,6 +249,14 @@ class CsvInferenceIteratorWidget(IteratorBase.IteratorWidgetBase):
   def onChangeImageColumn(self):
     self.validate()
 
+  # ------------------------------------------------------------------------------
+  def onChangeGTMaskColumns(self, text):
+    self._gtMaskColumns = self._splitColumnNames(text)
+
+  # ------------------------------------------------------------------------------
+  def onChangePredMaskColumns(self, text):
+    self._predMaskColumns = self._splitColumnNames(text)
+
   # ------------------------------------------------------------------------------
   def _parseConfig(self):
     """
@@ -228,11 +271,11 @@ class CsvInferenceIteratorWidget(IteratorBase.IteratorWidgetBase):
     assert self.imageSelector.text != ''  # Image column is a required column
     columnMap['image'] = str(self.imageSelector.text).strip()
 
-    if self.inputGTMaskColumnNames.text != '':
-      columnMap['gtMasks'] = [str(c).strip() for c in self.inputGTMaskColumnNames.text.split(',')]
+    if len(self._gtMaskColumns) > 0:
+      columnMap['gtMasks'] = list(self._gtMaskColumns)
 
-    if self.inputPredMaskColumnNames.text != '':
-      columnMap['predMasks'] = [str(c).strip() for c in self.inputPredMaskColumnNames.text.split(',')]
+    if len(self._predMaskColumns) > 0:
+      columnMap['predMasks'] = list(self._predMaskColumns)
 
     return columnMap
 
@@ -287,10 +330,13 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
     # Get the actual table contained in the MRML node
     self.batchTable = tableNode.GetTable()
 
-    self.caseColumns = self._getColumns(columnMap)
+    self.caseColumns = self._getColumns(columnMap, ('root', 'image'), ('gtMasks', 'predMasks'))
 
     self.caseCount = self.batchTable.GetNumberOfRows()  # Counter equalling the total number of cases
 
+    # IDs of the nodes of each loaded case, keyed by case index
+    self._caseData = {}
+
     self.cacheCases = cacheCases
     if self.cacheCases:
       self._tablesCache = dict()
@@ -304,59 +350,24 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
 
   def reset(self):
     if self.cacheCases:
-      for caseIdx in range(self.caseCount):
+      # Only visit the cases that were loaded, instead of every row in the table
+      for caseIdx in sorted(self._caseData):
         caseData = self.getCaseData(caseIdx)
         if caseData:
-          self.logger.info("Deleting casedata for {}".format(caseIdx))
+          self.logger.info('Deleting casedata for %d', caseIdx)
           im, gt_ma, pred_ma = caseData
           slicer.mrmlScene.RemoveNode(im)
           deque(map(slicer.mrmlScene.RemoveNode, gt_ma))
           deque(map(slicer.mrmlScene.RemoveNode, pred_ma))
-          self.parameterNode.UnsetParameter("CaseData_{}".format(caseIdx))
-          if caseIdx in list(self._tablesCache.keys()):
-            slicer.mrmlScene.RemoveNode(self._tablesCache[caseIdx])
-            del self._tablesCache[caseIdx]
         else:
-          self.logger.info("Cannot find case data for {}".format(caseIdx))
+          self.logger.info('Cannot find case data for %d', caseIdx)
+        table = self._tablesCache.pop(caseIdx, None)
+        if table is not None:
+          slicer.mrmlScene.RemoveNode(table)
+      self._caseData.clear()
     else:
       self.closeCase()
 
-  # ------------------------------------------------------------------------------
-  def _getColumns(self, columnMap):
-    caseColumns = {}
-
-    # Declare temporary function to parse out the user config and get the correct columns from the batchTable
-    def getColumn(key):
-      col = None
-      if key in columnMap:
-        col = self.batchTable.GetColumnByName(columnMap[key])
-        assert col is not None, 'Unable to find column "%s" (key %s)' % (columnMap[key], key)
-      caseColumns[key] = col
-
-    def getListColumn(key):
-      col_list = []
-      if key in columnMap:
-        for c_key in columnMap[key]:
-          col = self.batchTable.GetColumnByName(c_key)
-          assert col is not None, 'Unable to find column "%s" (key %s)' % (c_key, key)
-          col_list.append(col)
-      caseColumns[key] = col_list
-
-    # Special case: Check if there is a column "patient" or "ID" (used for additional naming of the case during logging)
-    patientColumn = self.batchTable.GetColumnByName('patient')
-    if patientColumn is None:
-      patientColumn = self.batchTable.GetColumnByName('ID')
-    if patientColumn is not None:
-      caseColumns['patient'] = patientColumn
-
-    # Get the other configurable columns
-    getColumn('root')
-    getColumn('image')
-    getListColumn('gtMasks')
-    getListColumn('predMasks')
-
-    return caseColumns
-
   # ------------------------------------------------------------------------------
   def loadCase(self, case_idx):
     assert 0 <= case_idx < self.caseCount, 'case_idx %d is out of range (n cases: %d)' % (case_idx, self.caseCount)
@@ -366,7 +377,7 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
 
     if not self.getCaseData(case_idx):
       if 'patient' in self.caseColumns:
-        patient = self.caseColumns['patient'].GetValue(case_idx)
+        patient = self.caseColumns['patient'][case_idx]
         self.logger.info('Loading patient (%d/%d): %s...', case_idx + 1, self.caseCount, patient)
       else:
         self.logger.info('Loading patient (%d/%d)...', case_idx + 1, self.caseCount)
@@ -392,11 +403,11 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
         if pred_ma_node is not None:
           predMaskNodes.append(pred_ma_node)
 
-      self.parameterNode.SetParameter("CaseData_{}".format(case_idx), {
+      self._caseData[case_idx] = {
         "InputImage_ID": im_node.GetID(),
         "GT_Mask_IDs": [node.GetID() for node in gtMaskNodes],
         "PRED_Mask_IDs": [node.GetID() for node in predMaskNodes],
-      }.__str__())
+      }
 
     self.currentIdx = case_idx
 
@@ -413,7 +424,7 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
         slicer.mrmlScene.RemoveNode(im)
         deque(map(slicer.mrmlScene.RemoveNode, gt_ma))
         deque(map(slicer.mrmlScene.RemoveNode, pred_ma))
-        self.parameterNode.UnsetParameter("CaseData_{}".format(self.currentIdx))
+        self._caseData.pop(self.currentIdx, None)
         if self._table:
           slicer.mrmlScene.RemoveNode(self._table)
         self.currentIdx = None
@@ -424,9 +435,8 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
     :return: image node, mask node, additional image nodes, additional mask nodes
     """
     caseIdx = caseIdx if caseIdx is not None else self.currentIdx
-    caseData = self.parameterNode.GetParameter("CaseData_{}".format(caseIdx))
+    caseData = self._caseData.get(caseIdx)
     if caseData:
-      caseData = eval(caseData)
       im_node = slicer.mrmlScene.GetNodeByID(caseData["InputImage_ID"])
       gt_mask_nodes = list(map(slicer.mrmlScene.GetNodeByID, caseData["GT_Mask_IDs"]))
       pred_mask_nodes = list(map(slicer.mrmlScene.GetNodeByID, caseData["PRED_Mask_IDs"]))
@@ -435,36 +445,14 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
       return None
 
   # ------------------------------------------------------------------------------
-  def _getColumnValue(self, colName, idx, is_list=False):
-    if colName not in self.caseColumns or self.caseColumns[colName] is None:
-      return None
-
-    if is_list:
-      return [col.GetValue(idx) for col in self.caseColumns[colName]]
-    else:
-      return self.caseColumns[colName].GetValue(idx)
-
-  # ------------------------------------------------------------------------------
-  def _buildPath(self, caseRoot, fname):
-    if fname is None or fname == '':
-      return None
-
-    if os.path.isabs(fname):
-      return fname
-
-    # Add the caseRoot if specified
-    if caseRoot is not None:
-      fname = os.path.join(caseRoot, fname)
-
-      # Check if the caseRoot is an absolute path
-      if os.path.isabs(fname):
-        return fname
-
-    # Add the csv_dir to the path if it is not None (loaded table)
-    if self.csv_dir is not None:
-      fname = os.path.join(self.csv_dir, fname)
-
-    return os.path.abspath(fname)
+  def getCaseFiles(self, case_idx):
+    if self.getCaseData(case_idx):  # Case is cached, so its files are not read again
+      return []
+    root = self._getColumnValue('root', case_idx)
+    fnames = [self._getColumnValue('image', case_idx)]
+    fnames += self._getColumnValue('gtMasks', case_idx, True) or []
+    fnames += self._getColumnValue('predMasks', case_idx, True) or []
+    return [path for path in (self._buildPath(root, fname) for fname in fnames) if path is not None]
 
   # ------------------------------------------------------------------------------
   def _loadImageNode(self, root, fname):
@@ -472,13 +460,13 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
     if im_path is None:
       return None
 
-    if not os.path.isfile(im_path):
+    if not self._isFile(im_path):
       self.logger.warning('Volume file %s does not exist, skipping...', fname)
       return None
 
-    load_success, im_node = slicer.util.loadVolume(im_path, returnNode=True)
+    load_success, im_node = slicer.util.loadVolume(im_path, properties={'show': False}, returnNode=True)
     if not load_success:
-      self.logger.warning('Failed to load ' + im_path)
+      self.logger.warning('Failed to load %s', im_path)
       return None
 
     # Use the file basename as the name for the loaded volume
@@ -493,7 +481,7 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
       return None
 
     # Check if the file actually exists
-    if not os.path.isfile(ma_path):
+    if not self._isFile(ma_path):
       self.logger.warning('Segmentation file %s does not exist, skipping...', fname)
       return None
 
@@ -506,7 +494,7 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
       load_success, ma_node = self.loadLabelIntoSegmentation(ma_path, ref_im, color)
 
     if not load_success:
-      self.logger.warning('Failed to load ' + ma_path)
+      self.logger.warning('Failed to load %s', ma_path)
       return None
 
     # Use the file basename as the name for the newly loaded segmentation node
@@ -521,7 +509,7 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
     # TODO: allow seg_node parameter to prevent creation of new node for every segment
     self.logger.debug('Loading labelmap and converting to segmentation')
 
-    load_success, ma_node = slicer.util.loadLabelVolume(ma_path, returnNode=True)
+    load_success, ma_node = slicer.util.loadLabelVolume(ma_path, properties={'show': False}, returnNode=True)
     if load_success:
       seg_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
       seg_node.SetReferenceImageGeometryParameterFromVolumeNode(ref_im)
@@ -539,15 +527,18 @@ class CsvInferenceIteratorLogic(IteratorBase.IteratorLogicBase):
 
 class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
 
-  COMPARISON_NAMES_GETTERS = OrderedDict({"Hausdorff_Maximum_mm": "GetMaximumHausdorffDistanceForVolumeMm",
-                                          "Hausdorff_Average_mm": "GetAverageHausdorffDistanceForBoundaryMm",
-                                          "Hausdorff_95_mm": "GetPercent95HausdorffDistanceForBoundaryMm",
-                                          "Dice_coefficient": "GetDiceCoefficient",
-                                          "Dice_Reference_volume_cc": "GetReferenceVolumeCc",
-                                          "Dice_Compare_volume_cc": "GetCompareVolumeCc"})
+  # NB: dicts preserve insertion order, which determines the order of the columns in the case tables
+  # Getters of the segment comparison node, grouped by the computation that sets them (each has its own validity flag)
+  HAUSDORFF_NAMES_GETTERS = {"Hausdorff_Maximum_mm": "GetMaximumHausdorffDistanceForVolumeMm",
+                             "Hausdorff_Average_mm": "GetAverageHausdorffDistanceForBoundaryMm",
+                             "Hausdorff_95_mm": "GetPercent95HausdorffDistanceForBoundaryMm"}
+  DICE_NAMES_GETTERS = {"Dice_coefficient": "GetDiceCoefficient",
+                        "Dice_Reference_volume_cc": "GetReferenceVolumeCc",
+                        "Dice_Compare_volume_cc": "GetCompareVolumeCc"}
+  COMPARISON_NAMES_GETTERS = dict(HAUSDORFF_NAMES_GETTERS, **DICE_NAMES_GETTERS)
 
   # NB: all additional metrics take gt, pred as inputs as either numpy or segmentation nodes
-  ADDITIONAL_METRIC_GETTERS = OrderedDict()
+  ADDITIONAL_METRIC_GETTERS = {}
 
   @classmethod
   def registerAdditionalMetric(cls, name, callback):
@@ -569,17 +560,11 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
       displayNode = seg_node.GetDisplayNode()
       displayNode.SetAllSegmentsVisibility(False)
 
-  @staticmethod
-  def _rotateToVolumePlanes(referenceVolume):
-    sliceNodes = slicer.util.getNodes('vtkMRMLSliceNode*')
-    for name, node in sliceNodes.items():
-      node.RotateToVolumePlane(referenceVolume)
-    # Snap to IJK to try and avoid rounding errors
-    sliceLogics = slicer.app.layoutManager().mrmlSliceLogics()
-    numLogics = sliceLogics.GetNumberOfItems()
-    for n in range(numLogics):
-      l = sliceLogics.GetItemAsObject(n)
-      l.FitSliceToAll()
+  def _rotateToVolumePlanes(self, referenceVolume):
+    # Each slice logic only changes its own slice node, so rotate and fit each view in a single pass
+    for sliceLogic in self.sliceLogics:
+      sliceLogic.GetSliceNode().RotateToVolumePlane(referenceVolume)
+      sliceLogic.FitSliceToAll()
 
   def __init__(self, reader=None, tableOutputDir=None):
     super(CsvTableEventHandler, self).__init__()
@@ -603,13 +588,12 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
       im, gt_ma, pred_ma = caller.getCaseData()
 
       # Set the slice viewers to the correct volumes
-      for sliceWidgetName in ['Red', 'Green', 'Yellow']:
-        logic = slicer.app.layoutManager().sliceWidget(sliceWidgetName).sliceLogic().GetSliceCompositeNode()
-        logic.SetBackgroundVolumeID(im.GetID())
+      for sliceLogic in self.sliceLogics:
+        sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(im.GetID())
 
       self._rotateToVolumePlanes(im)
 
-      if caller.table.GetNumberOfRows() == 0:
+      if caller.table.GetNumberOfColumns() == 0:
         self.initializeTableHeader(caller)
         self.createSegmentsComparison(gt_ma, pred_ma, caller.table)
 
@@ -618,8 +602,6 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
 
       self.setupFourUpTableViewConnection(caller)
     except Exception as e:
-      if slicer.app.majorVersion * 100 + slicer.app.minorVersion < 411:
-        e = e.message
       self.logger.warning("Error loading new case: %s", e)
       self.logger.debug('', exc_info=True)
 
@@ -628,9 +610,13 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
       self.fourUpTableView.selectionModel().selectionChanged.disconnect(self._onQuantificationRowChanged)
 
   def initializeTableHeader(self, caller):
-    for colName in ["Segments"] + list(self.COMPARISON_NAMES_GETTERS.keys()) + list(self.ADDITIONAL_METRIC_GETTERS.keys()):
-      col = caller.table.AddColumn()
-      col.SetName(colName)
+    wasModified = caller.table.StartModify()
+    try:
+      for colName in ["Segments"] + list(self.COMPARISON_NAMES_GETTERS.keys()) + list(self.ADDITIONAL_METRIC_GETTERS.keys()):
+        col = caller.table.AddColumn()
+        col.SetName(colName)
+    finally:
+      caller.table.EndModify(wasModified)
 
   def setupFourUpTableViewConnection(self, caller):
     if not slicer.app.layoutManager().tableWidget(0):
@@ -642,62 +628,93 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
     self.fourUpTableView = slicer.app.layoutManager().tableWidget(0).tableView()
     self.fourUpTableView.setSelectionBehavior(qt.QTableView.SelectRows)
 
-    def onQuantificationRowChanged(caller, itemSelection=None):
-      selectionModel = self.fourUpTableView.selectionModel()
-      selectedRows = [selectionModel.selectedRows()[idx].row() for idx in range(len(selectionModel.selectedRows()))]
-      self.hideAllSegmentations()
-      if selectedRows:
-        _, gt_masks, pred_masks = caller.getCaseData()
-        zipped = list(zip(gt_masks, pred_masks))
+    # The masks of the case do not change while it is loaded, so pair them up once instead of on every selection change
+    _, gt_masks, pred_masks = caller.getCaseData()
+    pairs = list(zip(gt_masks, pred_masks))
 
-        for selectedRow in selectedRows:
-          gt_mask, pred_mask = zipped[selectedRow]
-          self.showSegmentation(gt_mask)
-          self.showSegmentation(pred_mask)
+    def onQuantificationRowChanged(itemSelection=None):
+      selectedRows = [index.row() for index in self.fourUpTableView.selectionModel().selectedRows()]
+      self.hideAllSegmentations()
+      for selectedRow in selectedRows:
+        gt_mask, pred_mask = pairs[selectedRow]
+        self.showSegmentation(gt_mask)
+        self.showSegmentation(pred_mask)
 
-    self._onQuantificationRowChanged = lambda sel: onQuantificationRowChanged(caller, sel)
+    self._onQuantificationRowChanged = onQuantificationRowChanged
 
     self.fourUpTableView.selectionModel().selectionChanged.connect(self._onQuantificationRowChanged)
     self.fourUpTableView.selectAll()
 
-    onQuantificationRowChanged(caller)
+    onQuantificationRowChanged()
 
     threeDWidget = slicer.app.layoutManager().threeDWidget(0)
     threeDView = threeDWidget.threeDView()
     threeDView.resetFocalPoint()
 
   def createSegmentsComparison(self, gt_ma, pred_ma, table):
-    for rowIdx, (gt_seg, pred_seg) in enumerate(zip(gt_ma, pred_ma)):
-      assert len(CsvInferenceIteratorLogic.getAllSegmentIDs(gt_seg)) == 1
-      assert len(CsvInferenceIteratorLogic.getAllSegmentIDs(pred_seg)) == 1
-
-      segmentComparisonStats = self._compareSegments(gt_seg, pred_seg)
-      additionalMetrics = self._runAdditionalMetrics(gt_seg, pred_seg)
-
-      rowIdx = table.AddEmptyRow()
-      table.SetCellText(rowIdx, 0, "{}/{}".format(gt_seg.GetName(), pred_seg.GetName()))
-
-      for colIdx, stats in enumerate(segmentComparisonStats + additionalMetrics, start=1):
-        table.SetCellText(rowIdx, colIdx, stats)
-
-  def _compareSegments(self, gt_seg_node, pred_seg_node):
+    # Use a single comparison node for all pairs of segmentations, so the scene is only modified once to add and once
+    # to remove it
+    segmentComparisonNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentComparisonNode', 'Inference')
+    segmentComparisonLogic = slicer.modules.segmentcomparison.logic()
+    metricCount = len(self.COMPARISON_NAMES_GETTERS) + len(self.ADDITIONAL_METRIC_GETTERS)
+    rows = []
+    try:
+      for gt_seg, pred_seg in zip(gt_ma, pred_ma):
+        segmentsName = "{}/{}".format(gt_seg.GetName(), pred_seg.GetName())
+        # A failing pair still gets a row (with empty metrics), so the rows stay in line with the pairs of masks
+        try:
+          assert len(CsvInferenceIteratorLogic.getAllSegmentIDs(gt_seg)) == 1
+          assert len(CsvInferenceIteratorLogic.getAllSegmentIDs(pred_seg)) == 1
+
+          segmentComparisonStats = self._compareSegments(gt_seg, pred_seg, segmentComparisonNode,
+                                                         segmentComparisonLogic)
+          additionalMetrics = self._runAdditionalMetrics(gt_seg, pred_seg)
+          rows.append([segmentsName] + segmentComparisonStats + additionalMetrics)
+        except Exception as e:
+          self.logger.warning("Error comparing segments %s: %s", segmentsName, e)
+          self.logger.debug('', exc_info=True)
+          rows.append([segmentsName] + [''] * metricCount)
+    finally:
+      slicer.mrmlScene.RemoveNode(segmentComparisonNode)
+
+    # Size the table once and fill it a column at a time, so the table node is only modified once for all rows
+    wasModified = table.StartModify()
+    try:
+      vtkTable = table.GetTable()
+      vtkTable.SetNumberOfRows(len(rows))
+      for colIdx, values in enumerate(zip(*rows)):
+        col = vtkTable.GetColumn(colIdx)
+        for rowIdx, value in enumerate(values):
+          col.SetValue(rowIdx, value)
+      vtkTable.Modified()
+    finally:
+      table.EndModify(wasModified)
+
+  def _compareSegments(self, gt_seg_node, pred_seg_node, segmentComparisonNode, segmentComparisonLogic):
     gt_seg_id = self.getSegmentID(gt_seg_node)
     pred_seg_id = self.getSegmentID(pred_seg_node)
 
-    segmentComparisonNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentComparisonNode', 'Inference')
     segmentComparisonNode.SetAndObserveReferenceSegmentationNode(gt_seg_node)
     segmentComparisonNode.SetReferenceSegmentID(gt_seg_id)
     segmentComparisonNode.SetAndObserveCompareSegmentationNode(pred_seg_node)
     segmentComparisonNode.SetCompareSegmentID(pred_seg_id)
-    segmentComparisonLogic = slicer.modules.segmentcomparison.logic()
-    segmentComparisonLogic.ComputeHausdorffDistances(segmentComparisonNode)
-    segmentComparisonLogic.ComputeDiceStatistics(segmentComparisonNode)
+    # The comparison node is reused for all pairs, so check that the results were actually computed for this pair.
+    # Otherwise the node still holds the results of the previous pair.
+    hausdorffError = segmentComparisonLogic.ComputeHausdorffDistances(segmentComparisonNode)
+    hausdorffValid = not hausdorffError and segmentComparisonNode.GetHausdorffResultsValid()
+    if not hausdorffValid:
+      self.logger.warning('Failed to compute Hausdorff distances for %s/%s: %s',
+                          gt_seg_node.GetName(), pred_seg_node.GetName(), hausdorffError)
+    diceError = segmentComparisonLogic.ComputeDiceStatistics(segmentComparisonNode)
+    diceValid = not diceError and segmentComparisonNode.GetDiceResultsValid()
+    if not diceValid:
+      self.logger.warning('Failed to compute Dice statistics for %s/%s: %s',
+                          gt_seg_node.GetName(), pred_seg_node.GetName(), diceError)
 
     stats = list()
-    for getter in self.COMPARISON_NAMES_GETTERS.values():
-      stats.append(str(getattr(segmentComparisonNode, getter)()))
-
-    slicer.mrmlScene.RemoveNode(segmentComparisonNode)
+    for getters, valid in ((self.HAUSDORFF_NAMES_GETTERS, hausdorffValid), (self.DICE_NAMES_GETTERS, diceValid)):
+      for getter in getters.values():
+        stats.append(str(getattr(segmentComparisonNode, getter)()) if valid else '')
     return stats
 
   def getSegmentID(self, seg_node):
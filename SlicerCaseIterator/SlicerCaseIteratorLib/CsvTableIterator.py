@@ -12,9 +12,11 @@
 # ========================================================================
 
 import os
-import ast
+import hashlib
+import json
 from collections import deque
-import qt, ctk, slicer
+import qt, ctk, slicer, vtk
+from vtk.util import numpy_support
 
 from . import IteratorBase
 
@@ -31,6 +33,10 @@ class CaseTableIteratorWidget(IteratorBase.IteratorWidgetBase):
     self.tableNode = None
     self.tableStorageNode = None
 
+    # Column names parsed from the additional images/masks selectors, updated whenever their text changes
+    self._additionalImageColumns = ()
+    self._additionalMaskColumns = ()
+
   # ------------------------------------------------------------------------------
   def setup(self):
     self.CsvInputGroupBox = qt.QGroupBox('CSV input for local files')
@@ -120,6 +126,11 @@ class CaseTableIteratorWidget(IteratorBase.IteratorWidgetBase):
     #
     self.batchTableSelector.connect('nodeActivated(vtkMRMLNode*)', self.onChangeTable)
     self.imageSelector.connect('textEdited(QString)', self.onChangeImageColumn)
+    self.addImsSelector.connect('textChanged(QString)', self.onChangeAdditionalImageColumns)
+    self.addMasksSelector.connect('textChanged(QString)', self.onChangeAdditionalMaskColumns)
+
+    self.onChangeAdditionalImageColumns(self.addImsSelector.text)
+    self.onChangeAdditionalMaskColumns(self.addMasksSelector.text)
 
     self.segmentationParametersGroupBox = qt.QGroupBox('Mask interaction parameters')
     parametersFormLayout.addRow(self.segmentationParametersGroupBox)
@@ -187,7 +198,8 @@ class CaseTableIteratorWidget(IteratorBase.IteratorWidgetBase):
 
   # ------------------------------------------------------------------------------
   def cleanupBatch(self):
-    if self._iterator:
+    # No case is open if the batch failed to start, or after the last case was processed
+    if self._iterator and self._iterator.currentIdx is not None:
       self._iterator.closeCase()
     self.tableNode = None
     self.tableStorageNode = None
@@ -202,6 +214,14 @@ class CaseTableIteratorWidget(IteratorBase.IteratorWidgetBase):
   def onChangeImageColumn(self):
     self.validate()
 
+  # ------------------------------------------------------------------------------
+  def onChangeAdditionalImageColumns(self, text):
+    self._additionalImageColumns = self._splitColumnNames(text)
+
+  # ------------------------------------------------------------------------------
+  def onChangeAdditionalMaskColumns(self, text):
+    self._additionalMaskColumns = self._splitColumnNames(text)
+
   # ------------------------------------------------------------------------------
   def _parseConfig(self):
     """
@@ -219,11 +239,11 @@ class CaseTableIteratorWidget(IteratorBase.IteratorWidgetBase):
     if self.maskSelector.text != '':
       columnMap['mask'] = str(self.maskSelector.text).strip()
 
-    if self.addImsSelector.text != '':
-      columnMap['additionalImages'] = [str(c).strip() for c in self.addImsSelector.text.split(',')]
+    if len(self._additionalImageColumns) > 0:
+      columnMap['additionalImages'] = list(self._additionalImageColumns)
 
-    if self.addMasksSelector.text != '':
-      columnMap['additionalMasks'] = [str(c).strip() for c in self.addMasksSelector.text.split(',')]
+    if len(self._additionalMaskColumns) > 0:
+      columnMap['additionalMasks'] = list(self._additionalMaskColumns)
 
     return columnMap
 
@@ -249,8 +269,8 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
     # Get the actual table contained in the MRML node
     self.batchTable = tableNode.GetTable()
 
-    # Dictionary holding the specified (and found) columns from the tableNode
-    self.caseColumns = self._getColumns(columnMap)
+    # Dictionary holding the values of the specified (and found) columns from the tableNode
+    self.caseColumns = self._getColumns(columnMap, ('root', 'image', 'mask'), ('additionalImages', 'additionalMasks'))
 
     self.caseCount = self.batchTable.GetNumberOfRows()  # Counter equalling the total number of cases
 
@@ -261,43 +281,6 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
     self.batchTable = None
     self.caseColumns = None
 
-  # ------------------------------------------------------------------------------
-  def _getColumns(self, columnMap):
-    caseColumns = {}
-
-    # Declare temporary function to parse out the user config and get the correct columns from the batchTable
-    def getColumn(key):
-      col = None
-      if key in columnMap:
-        col = self.batchTable.GetColumnByName(columnMap[key])
-        assert col is not None, 'Unable to find column "%s" (key %s)' % (columnMap[key], key)
-      caseColumns[key] = col
-
-    def getListColumn(key):
-      col_list = []
-      if key in columnMap:
-        for c_key in columnMap[key]:
-          col = self.batchTable.GetColumnByName(c_key)
-          assert col is not None, 'Unable to find column "%s" (key %s)' % (c_key, key)
-          col_list.append(col)
-      caseColumns[key] = col_list
-
-    # Special case: Check if there is a column "patient" or "ID" (used for additional naming of the case during logging)
-    patientColumn = self.batchTable.GetColumnByName('patient')
-    if patientColumn is None:
-      patientColumn = self.batchTable.GetColumnByName('ID')
-    if patientColumn is not None:
-      caseColumns['patient'] = patientColumn
-
-    # Get the other configurable columns
-    getColumn('root')
-    getColumn('image')
-    getColumn('mask')
-    getListColumn('additionalImages')
-    getListColumn('additionalMasks')
-
-    return caseColumns
-
   # ------------------------------------------------------------------------------
   def loadCase(self, case_idx):
     assert 0 <= case_idx < self.caseCount, 'case_idx %d is out of range (n cases: %d)' % (case_idx, self.caseCount)
@@ -306,7 +289,7 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
       self.closeCase()
 
     if 'patient' in self.caseColumns:
-      patient = self.caseColumns['patient'].GetValue(case_idx)
+      patient = self.caseColumns['patient'][case_idx]
       self.logger.info('Loading patient (%d/%d): %s...', case_idx + 1, self.caseCount, patient)
     else:
       self.logger.info('Loading patient (%d/%d)...', case_idx + 1, self.caseCount)
@@ -337,12 +320,12 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
       if add_ma_node is not None:
         additionalMaskNodes.append(add_ma_node)
 
-    self.parameterNode.SetParameter("CaseData", {
+    self.parameterNode.SetParameter("CaseData", json.dumps({
       "InputImage_ID": im_node.GetID(),
       "InputMask_ID": ma_node.GetID(),
       "Additional_InputImage_IDs": [node.GetID() for node in additionalImageNodes],
       "Additional_InputMask_IDs": [node.GetID() for node in additionalMaskNodes],
-    }.__str__())
+    }))
 
     self.currentIdx = case_idx
 
@@ -351,7 +334,7 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
 
   def closeCase(self):
     self._eventListeners.caseAboutToClose(self.parameterNode)
-    caseData = ast.literal_eval(self.parameterNode.GetParameter("CaseData"))
+    caseData = json.loads(self.parameterNode.GetParameter("CaseData"))
 
     self.removeNodeByID(caseData["InputImage_ID"])
     self.removeNodeByID(caseData["InputMask_ID"])
@@ -364,7 +347,7 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
     :return: image node, mask node, additional image nodes, additional mask nodes
     """
     if self.parameterNode:
-      caseData = eval(self.parameterNode.GetParameter("CaseData"))
+      caseData = json.loads(self.parameterNode.GetParameter("CaseData"))
       im = slicer.mrmlScene.GetNodeByID(caseData["InputImage_ID"])
       ma = slicer.mrmlScene.GetNodeByID(caseData["InputMask_ID"])
       add_im = list(map(slicer.mrmlScene.GetNodeByID, caseData["Additional_InputImage_IDs"]))
@@ -374,36 +357,12 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
       return [None] * 4
 
   # ------------------------------------------------------------------------------
-  def _getColumnValue(self, colName, idx, is_list=False):
-    if colName not in self.caseColumns or self.caseColumns[colName] is None:
-      return None
-
-    if is_list:
-      return [col.GetValue(idx) for col in self.caseColumns[colName]]
-    else:
-      return self.caseColumns[colName].GetValue(idx)
-
-  # ------------------------------------------------------------------------------
-  def _buildPath(self, caseRoot, fname):
-    if fname is None or fname == '':
-      return None
-
-    if os.path.isabs(fname):
-      return fname
-
-    # Add the caseRoot if specified
-    if caseRoot is not None:
-      fname = os.path.join(caseRoot, fname)
-
-      # Check if the caseRoot is an absolute path
-      if os.path.isabs(fname):
-        return fname
-
-    # Add the csv_dir to the path if it is not None (loaded table)
-    if self.csv_dir is not None:
-      fname = os.path.join(self.csv_dir, fname)
-
-    return os.path.abspath(fname)
+  def getCaseFiles(self, case_idx):
+    root = self._getColumnValue('root', case_idx)
+    fnames = [self._getColumnValue('image', case_idx), self._getColumnValue('mask', case_idx)]
+    fnames += self._getColumnValue('additionalImages', case_idx, True) or []
+    fnames += self._getColumnValue('additionalMasks', case_idx, True) or []
+    return [path for path in (self._buildPath(root, fname) for fname in fnames) if path is not None]
 
   # ------------------------------------------------------------------------------
   def _loadImageNode(self, root, fname):
@@ -411,13 +370,13 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
     if im_path is None:
       return None
 
-    if not os.path.isfile(im_path):
+    if not self._isFile(im_path):
       self.logger.warning('Volume file %s does not exist, skipping...', fname)
       return None
 
-    load_success, im_node = slicer.util.loadVolume(im_path, returnNode=True)
+    load_success, im_node = slicer.util.loadVolume(im_path, properties={'show': False}, returnNode=True)
     if not load_success:
-      self.logger.warning('Failed to load ' + im_path)
+      self.logger.warning('Failed to load %s', im_path)
       return None
 
     # Use the file basename as the name for the loaded volume
@@ -432,7 +391,7 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
       return None
 
     # Check if the file actually exists
-    if not os.path.isfile(ma_path):
+    if not self._isFile(ma_path):
       self.logger.warning('Segmentation file %s does not exist, skipping...', fname)
       return None
 
@@ -445,7 +404,7 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
     else:
       self.logger.debug('Loading labelmap and converting to segmentation')
       # If not segmentation, then load as labelmap then convert to segmentation
-      load_success, ma_node = slicer.util.loadLabelVolume(ma_path, returnNode=True)
+      load_success, ma_node = slicer.util.loadLabelVolume(ma_path, properties={'show': False}, returnNode=True)
       if load_success:
         # Only try to make a segmentation node if Slicer was able to load the label map
         seg_node = slicer.vtkMRMLSegmentationNode()
@@ -467,7 +426,7 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
         store_node.UnRegister(None)
 
     if not load_success:
-      self.logger.warning('Failed to load ' + ma_path)
+      self.logger.warning('Failed to load %s', ma_path)
       return None
 
     # Use the file basename as the name for the newly loaded segmentation node
@@ -482,6 +441,10 @@ class CaseTableIteratorLogic(IteratorBase.IteratorLogicBase):
 
 class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
 
+  # Node attribute holding the digest of a loaded mask, used to skip saving masks that were not edited when no reader
+  # is set (saving these would only write a copy of the file they were loaded from)
+  MASK_HASH_ATTRIBUTE = 'SlicerCaseIterator.LoadedMaskHash'
+
   def __init__(self, redirect, reader=None, saveNew=False, saveLoaded=False):
     super(CsvTableEventHandler, self).__init__()
 
@@ -491,28 +454,101 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
     self.saveNew = saveNew
     self.saveLoaded = saveLoaded
 
+    # IDs of segmentation nodes added to the scene while a case is loaded (i.e. new masks), tracked by a scene observer
+    self._newMaskIDs = []
+    self._nodeAddedObserverTag = None
+
+    self._segmentEditorWidget = None
+
+  @property
+  def segmentEditorWidget(self):
+    # The Segment Editor module widget (and its editor) is created once and kept by Slicer, so look it up only once
+    if self._segmentEditorWidget is None:
+      self._segmentEditorWidget = slicer.modules.segmenteditor.widgetRepresentation().self().editor
+    return self._segmentEditorWidget
+
+  def _rotateToVolumePlanes(self, referenceVolume):
+    # Each slice logic only changes its own slice node, so rotate, fit and snap each view in a single pass.
+    # Volumes are loaded without showing them, so fit the views here. Then snap to IJK to try and avoid rounding errors
+    for sliceLogic in self.sliceLogics:
+      sliceLogic.GetSliceNode().RotateToVolumePlane(referenceVolume)
+      sliceLogic.FitSliceToAll()
+      sliceLogic.SnapSliceOffsetToIJK()
+
   @staticmethod
-  def _rotateToVolumePlanes(referenceVolume):
-    sliceNodes = slicer.util.getNodes('vtkMRMLSliceNode*')
-    for name, node in sliceNodes.items():
-      node.RotateToVolumePlane(referenceVolume)
-    # Snap to IJK to try and avoid rounding errors
-    sliceLogics = slicer.app.layoutManager().mrmlSliceLogics()
-    numLogics = sliceLogics.GetNumberOfItems()
-    for n in range(numLogics):
-      l = sliceLogics.GetItemAsObject(n)
-      l.SnapSliceOffsetToIJK()
+  def _hashMask(segmentationNode):
+    """
+    Compute a digest of the content of a segmentation node (segment IDs, names, colors and binary labelmaps).
+    :return: hex digest, or None if not all segments have a binary labelmap representation
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    segmentation = segmentationNode.GetSegmentation()
+    layerIndices = {}  # Segments can share a labelmap layer, so each distinct layer is only hashed once
+    for segmentIdx in range(segmentation.GetNumberOfSegments()):
+      segment = segmentation.GetNthSegment(segmentIdx)
+      labelmap = segment.GetRepresentation('Binary labelmap')
+      if labelmap is None or labelmap.GetPointData().GetScalars() is None:
+        return None
+      layerIdx = layerIndices.get(labelmap)
+      if layerIdx is None:
+        layerIdx = layerIndices[labelmap] = len(layerIndices)
+        digest.update(repr(labelmap.GetExtent()).encode())
+        digest.update(numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()).tobytes())
+      digest.update(repr((segmentation.GetNthSegmentID(segmentIdx), segment.GetName(), segment.GetColor(),
+                          segment.GetLabelValue(), layerIdx)).encode())
+    return digest.hexdigest()
+
+  def _isUnchangedMask(self, node):
+    """
+    Check whether a loaded mask still matches its content at load time and the file it was loaded from still exists.
+    """
+    loadedHash = node.GetAttribute(self.MASK_HASH_ATTRIBUTE)
+    if loadedHash is None:
+      return False
+    storage_node = node.GetStorageNode()
+    if storage_node is None or storage_node.GetFileName() is None or not os.path.isfile(storage_node.GetFileName()):
+      return False
+    return self._hashMask(node) == loadedHash
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeAdded(self, caller, event, node):
+    if node.IsA('vtkMRMLSegmentationNode') and node.GetID() not in self._newMaskIDs:
+      self._newMaskIDs.append(node.GetID())
+
+  def _startTrackingNewMasks(self):
+    self._stopTrackingNewMasks()
+    self._newMaskIDs = []
+    self._nodeAddedObserverTag = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self._onNodeAdded)
+
+  def _stopTrackingNewMasks(self):
+    if self._nodeAddedObserverTag is not None:
+      slicer.mrmlScene.RemoveObserver(self._nodeAddedObserverTag)
+      self._nodeAddedObserverTag = None
 
   def onCaseLoaded(self, caller, *args, **kwargs):
+    if self.saveNew:
+      # Masks of the case are already loaded, so only masks created during the review are tracked
+      self._startTrackingNewMasks()
+
     try:
       im, ma, add_im, add_ma = caller.getCaseData()
 
-      # Set the slice viewers to the correct volumes
-      for sliceWidgetName in ['Red', 'Green', 'Yellow']:
-        logic = slicer.app.layoutManager().sliceWidget(sliceWidgetName).sliceLogic().GetSliceCompositeNode()
-        logic.SetBackgroundVolumeID(im.GetID())
+      if self.saveLoaded and self.reader is None:
+        # Store the content digest of the loaded masks, so unchanged masks are not written again on close
+        for mask in [ma] + add_ma:
+          if mask is not None:
+            maskHash = self._hashMask(mask)
+            if maskHash is not None:
+              mask.SetAttribute(self.MASK_HASH_ATTRIBUTE, maskHash)
+
+      # Set the slice viewers to the correct volumes, modifying each composite node in a single transaction
+      for sliceLogic in self.sliceLogics:
+        compositeNode = sliceLogic.GetSliceCompositeNode()
+        wasModifying = compositeNode.StartModify()
+        compositeNode.SetBackgroundVolumeID(im.GetID())
         if len(add_im) > 0:
-          logic.SetForegroundVolumeID(add_im[0].GetID())
+          compositeNode.SetForegroundVolumeID(add_im[0].GetID())
+        compositeNode.EndModify(wasModifying)
 
       # Snap the viewers to the slice plane of the main image
       self._rotateToVolumePlanes(im)
@@ -525,14 +561,11 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
           slicer.modules.SegmentEditorWidget.enter()
 
         # Explicitly set the segmentation and master volume nodes
-        segmentEditorWidget = slicer.modules.segmenteditor.widgetRepresentation().self().editor
         if ma is not None:
-          segmentEditorWidget.setSegmentationNode(ma)
-        segmentEditorWidget.setMasterVolumeNode(im)
+          self.segmentEditorWidget.setSegmentationNode(ma)
+        self.segmentEditorWidget.setMasterVolumeNode(im)
 
     except Exception as e:
-      if slicer.app.majorVersion * 100 + slicer.app.minorVersion < 411:
-        e = e.message
       self.logger.warning("Error loading new case: %s", e)
       self.logger.debug('', exc_info=True)
 
@@ -540,16 +573,22 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
     caseData = caller.getCaseData()
     _, mask, _, additionalMasks = caseData
     if self.saveLoaded:
-      if mask is not None:
-        self.saveMask(mask, self.reader, caseData)
-      for ma in additionalMasks:
-        self.saveMask(ma, self.reader, caseData)
+      for ma in [mask] + additionalMasks:
+        if ma is None:
+          continue
+        # With a reader set, a reviewed mask is always saved to a file for that reader, even if it was not edited
+        if self.reader is None and self._isUnchangedMask(ma):
+          self.logger.info('Mask %s is unchanged, skipping save', ma.GetName())
+        else:
+          self.saveMask(ma, self.reader, caseData)
     if self.saveNew:
+      self._stopTrackingNewMasks()
       # TODO: this should depend on if more segments were added in segmentation node not depending on a new
-      nodes = [n for n in slicer.util.getNodesByClass('vtkMRMLSegmentationNode')
-               if n not in additionalMasks and n != mask]
-
-      deque(map(lambda n: self.saveMask(n, self.reader, caseData), nodes))
+      for nodeID in self._newMaskIDs:
+        node = slicer.mrmlScene.GetNodeByID(nodeID)
+        if node is not None:  # Skip new masks that were removed again during the review
+          self.saveMask(node, self.reader, caseData)
+      self._newMaskIDs = []
 
     if slicer.util.selectedModule() == 'SegmentEditor':
       slicer.modules.SegmentEditorWidget.exit()
@@ -571,19 +610,19 @@ class CsvTableEventHandler(IteratorBase.IteratorEventHandlerBase):
     nodename = node.GetName()
 
     if reader is not None:
-      nodename += '_' + reader
-    filename = os.path.join(target_dir, nodename)
+      nodename = f'{nodename}_{reader}'
+    filename = os.path.join(target_dir, f'{nodename}.seg.nrrd')
 
     # Prevent overwriting existing files
-    if os.path.exists(filename + '.seg.nrrd') and not overwrite_existing:
+    if not overwrite_existing and os.path.exists(filename):
       self.logger.debug('Filename exists! Generating unique name...')
+      # List the directory once instead of checking each candidate name on disk. Compare lowercase names, so no
+      # existing file is overwritten on case-insensitive file systems.
+      existing_files = {f.lower() for f in os.listdir(target_dir)}
       idx = 1
-      filename += '(%d).seg.nrrd'
-      while os.path.exists(filename % idx):
+      while f'{nodename}({idx}).seg.nrrd'.lower() in existing_files:
         idx += 1
-      filename = filename % idx
-    else:
-      filename += '.seg.nrrd'
+      filename = os.path.join(target_dir, f'{nodename}({idx}).seg.nrrd')
 
     # Save the node
     slicer.util.saveNode(node, filename)
@@ -11,6 +11,7 @@
 #  limitations under the License.
 # ========================================================================
 
+import os
 import slicer
 from abc import abstractmethod
 import logging
@@ -65,6 +66,15 @@ class IteratorWidgetBase(object):
     """
     return True
 
+  @staticmethod
+  def _splitColumnNames(text):
+    """
+    Split the text of a selector specifying multiple columns into its separate column names. Empty entries are dropped.
+    :param text: comma separated column names
+    :return: tuple of column names
+    """
+    return tuple(c for c in (c.strip() for c in str(text).split(',')) if c != '')
+
   @abstractmethod
   def startBatch(self, reader=None):
     """
@@ -135,6 +145,13 @@ class IteratorLogicBase(object):
     self.caseCount = None
     self._eventListeners = IteratorEventListenerList(self)
 
+    # Directory relative file paths are resolved against (see _buildPath), e.g. the directory of the case table file
+    self.csv_dir = None
+
+    # Names of the files in each directory checked during this batch, used to check file existence without a stat call
+    # for every file
+    self._directoryFiles = {}
+
   def __del__(self):
     self.logger.debug('Destroying Case Iterator Logic instance')
     if self.currentIdx is not None:
@@ -180,6 +197,116 @@ class IteratorLogicBase(object):
     :return: None
     """
 
+  def getCaseFiles(self, case_idx):
+    """
+    Function called by the logic to get the files of a case, which are then read in the background to speed up loading
+    that case. Iterators that do not load from local files can keep this default, which disables prefetching.
+    :param case_idx: index of the case, 0 <= case_idx < self.caseCount
+    :return: list of file paths
+    """
+    return []
+
+  @staticmethod
+  def readFiles(paths, chunk_size=1 << 20, stopEvent=None):
+    """
+    Read the specified files without keeping their contents, so they are in the OS file cache when they are loaded.
+    This does not touch the MRML scene, and is therefore safe to run in a background thread.
+    :param paths: list of file paths, e.g. as returned by ``getCaseFiles``
+    :param chunk_size: number of bytes to read at a time
+    :param stopEvent: optional ``threading.Event``, reading stops after the current chunk once it is set
+    :return: None
+    """
+    for path in paths:
+      try:
+        with open(path, 'rb') as f:
+          while f.read(chunk_size):
+            if stopEvent is not None and stopEvent.is_set():
+              return
+      except OSError:
+        pass  # Missing or unreadable files are reported when the case is actually loaded
+
+  def _buildPath(self, caseRoot, fname):
+    """
+    Resolve fname relative to caseRoot (if specified), which in turn is relative to ``self.csv_dir`` (if set).
+    os.path.join discards all parts preceding an absolute part, so absolute paths in fname or caseRoot need no separate
+    checks.
+    :return: absolute path, or None if no fname is specified
+    """
+    if fname is None or fname == '':
+      return None
+
+    parts = [part for part in (self.csv_dir, caseRoot, fname) if part is not None]
+    return os.path.abspath(os.path.join(*parts))
+
+  def _isFile(self, path):
+    """
+    Check whether path is an existing file, using a listing of its directory that is made once per batch.
+    :return: boolean
+    """
+    directory, fname = os.path.split(path)
+    files = self._directoryFiles.get(directory)
+    if files is None:
+      try:
+        with os.scandir(directory) as entries:
+          files = {entry.name for entry in entries if entry.is_file()}
+      except OSError:
+        files = set()
+      self._directoryFiles[directory] = files
+    # Names not in the listing are checked on disk, e.g. when they differ in case on a case-insensitive file system,
+    # or when the file was added after the directory was listed
+    return fname in files or os.path.isfile(path)
+
+  def _getColumns(self, columnMap, columnKeys, listColumnKeys):
+    """
+    Copy the values of the configured columns out of ``self.batchTable`` once, so getting the value(s) for a case is a
+    plain list lookup (see ``_getColumnValue``). A column "patient" or "ID", if present, is included as "patient" (used
+    for additional naming of the case during logging).
+    :param columnMap: Dictionary mapping keys to a column name (keys in columnKeys) or list of column names (keys in
+      listColumnKeys)
+    :param columnKeys: keys of the columns holding a single value per case, None if not in columnMap
+    :param listColumnKeys: keys of the columns holding multiple values per case, an empty list if not in columnMap
+    :return: Dictionary mapping keys to the list of values of the column, or to a list of such lists
+    """
+    caseColumns = {}
+
+    # Map all column names to their columns in a single pass over the table, so each lookup below is a dict lookup
+    # instead of a linear search through the columns of the VTK table
+    tableColumns = {}
+    for colIdx in range(self.batchTable.GetNumberOfColumns()):
+      col = self.batchTable.GetColumn(colIdx)
+      tableColumns.setdefault(col.GetName(), col)
+
+    rowCount = self.batchTable.GetNumberOfRows()
+
+    def getValues(colName, key):
+      col = tableColumns.get(colName)
+      assert col is not None, 'Unable to find column "%s" (key %s)' % (colName, key)
+      return [col.GetValue(rowIdx) for rowIdx in range(rowCount)]
+
+    patientColumnName = 'patient' if 'patient' in tableColumns else 'ID'
+    if patientColumnName in tableColumns:
+      caseColumns['patient'] = getValues(patientColumnName, 'patient')
+
+    for key in columnKeys:
+      caseColumns[key] = getValues(columnMap[key], key) if key in columnMap else None
+    for key in listColumnKeys:
+      caseColumns[key] = [getValues(colName, key) for colName in columnMap.get(key, [])]
+
+    return caseColumns
+
+  def _getColumnValue(self, colName, idx, is_list=False):
+    """
+    Get the value(s) of a case from the columns returned by ``_getColumns`` (stored in ``self.caseColumns``).
+    :return: value, list of values if is_list is True, or None if the column is not configured
+    """
+    if colName not in self.caseColumns or self.caseColumns[colName] is None:
+      return None
+
+    if is_list:
+      return [col[idx] for col in self.caseColumns[colName]]
+    else:
+      return self.caseColumns[colName][idx]
+
   @abstractmethod
   def getCaseData(self):
     """
@@ -193,8 +320,28 @@ class IteratorEventHandlerBase(object):
 
   """
 
+  SLICE_WIDGET_NAMES = ('Red', 'Green', 'Yellow')
+
   def __init__(self):
     self.logger = logging.getLogger(self.__class__.__name__)
+    self._sliceLogics = None
+
+  @property
+  def sliceLogics(self):
+    """
+    Slice logics of the standard slice views (see SLICE_WIDGET_NAMES). These live as long as the layout manager (also
+    across layout changes and scene closes), so they are only looked up on first use. Views that do not exist (e.g. in
+    custom layouts) are skipped, and looked up again on the next use.
+    :return: tuple of vtkMRMLSliceLogic
+    """
+    if self._sliceLogics is None:
+      layoutManager = slicer.app.layoutManager()
+      sliceWidgets = [layoutManager.sliceWidget(sliceWidgetName) for sliceWidgetName in self.SLICE_WIDGET_NAMES]
+      sliceLogics = tuple(sliceWidget.sliceLogic() for sliceWidget in sliceWidgets if sliceWidget is not None)
+      if len(sliceLogics) < len(sliceWidgets):
+        return sliceLogics
+      self._sliceLogics = sliceLogics
+    return self._sliceLogics
 
   @abstractmethod
   def onCaseLoaded(self, caller, *args, **kwargs):
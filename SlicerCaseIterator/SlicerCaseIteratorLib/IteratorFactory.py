@@ -26,10 +26,10 @@ class IteratorFactory(object):
   @classmethod
   def registerIteratorWidget(cls, name, widget):
     if name in cls.IMPLEMENTATIONS.keys():
-      logging.warning(f"Iterator {name} is already registered")
+      logging.warning("Iterator %s is already registered", name)
       return
     if not issubclass(widget, IteratorBase.IteratorWidgetBase):
-      logging.warning(f"Widget {widget} is no subclass of IteratorBase.IteratorWidgetBase")
+      logging.warning("Widget %s is no subclass of IteratorBase.IteratorWidgetBase", widget)
       return
     cls.IMPLEMENTATIONS[name] = widget
 